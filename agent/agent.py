@@ -12,9 +12,9 @@ Based on LiveKit docs: https://docs.livekit.io/
 """
 
 import asyncio
-import json
 import os
-import requests
+import httpx
+import orjson
 from dotenv import load_dotenv
 from livekit.agents import (
     Agent,
@@ -92,16 +92,23 @@ Remember: Answer only from provided documents, concisely, with citations for eve
 """
 
 
-def retrieve_context(query: str) -> dict:
+# Chat item id of the injected RAG context block
+RAG_CONTEXT_ID = "rag_context"
+
+_HTTP = httpx.AsyncClient(
+    base_url=os.getenv("RAG_BACKEND_URL", "http://localhost:8000"),
+    limits=httpx.Limits(max_keepalive_connections=8, max_connections=32),
+    timeout=10.0,
+)
+
+
+async def retrieve_context(query: str) -> dict:
     """Fetch relevant documents from the RAG backend."""
     try:
-        base_url = os.getenv("RAG_BACKEND_URL", "http://localhost:8000")
-        response = requests.post(
-            f"{base_url}/retrieve", json={"query": query, "k": 4}, timeout=10
-        )
+        response = await _HTTP.post("/retrieve", json={"query": query, "k": 4})
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        return orjson.loads(response.content)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         print(f"RAG retrieve error: {e}")
         return {"documents": [], "metadatas": []}
 
@@ -179,6 +186,9 @@ class RAGAgent(Agent):
             llm=get_llm(),
         )
         self._publish_rag_sources = publish_rag_sources
+        self._last_context_hash = None
+        self._context_content = None
+        self._prefetch = None
 
     async def on_enter(self):
         """Called when agent becomes active - greet the user."""
@@ -186,6 +196,22 @@ class RAGAgent(Agent):
             instructions="Greet the user briefly and let them know you can answer questions about their uploaded documents.",
         )
 
+    def prefetch_context(self, transcript: str) -> None:
+        """Start RAG retrieval for a final transcript while the turn is still being endpointed."""
+        if self._prefetch is not None:
+            self._prefetch[1].cancel()
+        self._prefetch = (transcript, asyncio.create_task(retrieve_context(transcript)))
+
+    async def _get_context(self, query: str) -> dict:
+        """Use the prefetched retrieval if it was for this query, otherwise fetch now."""
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            transcript, task = prefetch
+            if transcript.strip() == query.strip():
+                return await task
+            task.cancel()
+        return await retrieve_context(query)
+
     async def on_user_turn_completed(
         self, turn_ctx: ChatContext, new_message: ChatMessage
     ) -> None:
@@ -203,7 +229,7 @@ class RAGAgent(Agent):
 
         print(f"RAG lookup for: {user_query[:100]}...")
 
-        rag_result = retrieve_context(user_query)
+        rag_result = await self._get_context(user_query)
         docs = rag_result.get("documents", []) or []
         metadatas = rag_result.get("metadatas", []) or []
 
@@ -211,7 +237,7 @@ class RAGAgent(Agent):
 
         if self._publish_rag_sources and docs:
             try:
-                sources_payload = json.dumps(
+                sources_payload = orjson.dumps(
                     {
                         "documents": docs,
                         "sources": [
@@ -228,18 +254,37 @@ class RAGAgent(Agent):
             except Exception as e:
                 print(f"Error publishing RAG sources: {e}")
 
-        if docs:
-            context = "\n\n---\n\n".join(docs)
-            turn_ctx.add_message(
-                role="assistant",
-                content=f"Here is relevant context from the knowledge base to help answer the user's question:\n\n{context}",
-            )
-            print("Injected RAG context into chat")
+        context_hash = hash(tuple(docs))
+        if context_hash != self._last_context_hash:
+            if docs:
+                parts = ["Here is relevant context from the knowledge base to help answer the user's question:\n\n"]
+                for doc in docs:
+                    parts.append(doc)
+                    parts.append("\n\n---\n\n")
+                parts.pop()
+                self._context_content = "".join(parts)
+                print("Injected RAG context into chat")
+            else:
+                self._context_content = "No relevant context was found in the knowledge base for this question."
+            self._last_context_hash = context_hash
         else:
-            turn_ctx.add_message(
-                role="assistant",
-                content="No relevant context was found in the knowledge base for this question.",
-            )
+            print("RAG context unchanged, reusing cached prefix")
+
+        self._place_context(turn_ctx, self._context_content)
+
+    @staticmethod
+    def _place_context(turn_ctx: ChatContext, content: str) -> None:
+        """Put the RAG context block right after the system prompt, replacing any previous one.
+
+        Keeping it at a fixed position ahead of the chat history gives the LLM
+        provider a stable prompt prefix to reuse across turns.
+        """
+        items = turn_ctx.items
+        items[:] = [item for item in items if item.id != RAG_CONTEXT_ID]
+        pos = 0
+        while pos < len(items) and getattr(items[pos], "role", None) in ("system", "developer"):
+            pos += 1
+        items.insert(pos, ChatMessage(id=RAG_CONTEXT_ID, role="assistant", content=[content]))
 
 
 server = AgentServer()
@@ -282,18 +327,18 @@ async def entrypoint(ctx: JobContext):
     system_prompt = DEFAULT_SYSTEM_PROMPT
     if participant.metadata:
         try:
-            meta = json.loads(participant.metadata)
+            meta = orjson.loads(participant.metadata)
             if meta.get("system_prompt"):
                 system_prompt = meta["system_prompt"]
                 print("Using custom system prompt from metadata")
-        except (json.JSONDecodeError, TypeError):
+        except (orjson.JSONDecodeError, TypeError):
             pass
 
-    async def publish_rag_sources(payload: str):
+    async def publish_rag_sources(payload: bytes):
         try:
             if ctx.room.isconnected():
                 await ctx.room.local_participant.publish_data(
-                    payload.encode(),
+                    payload,
                     topic="rag_sources",
                 )
                 print("Published RAG sources")
@@ -335,12 +380,13 @@ async def entrypoint(ctx: JobContext):
 
         if transcript and is_final:
             print(f"User: {transcript}")
+            agent.prefetch_context(transcript)
 
             async def _publish():
                 try:
                     if ctx.room.isconnected():
                         await ctx.room.local_participant.publish_data(
-                            f"USER:{transcript}".encode(),
+                            b"USER:" + transcript.encode(),
                             topic="transcript",
                         )
                 except Exception as e:
@@ -367,7 +413,7 @@ async def entrypoint(ctx: JobContext):
                 try:
                     if ctx.room.isconnected():
                         await ctx.room.local_participant.publish_data(
-                            f"BOT:{text}".encode(),
+                            b"BOT:" + text.encode(),
                             topic="transcript",
                         )
                 except Exception as e:
@@ -5,7 +5,9 @@ import json
 import logging
 import uuid
 import sys
+import tempfile
 from fastapi import FastAPI, UploadFile, File, HTTPException, Body
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
@@ -21,6 +23,9 @@ if _parent_dir not in sys.path:
 
 try:
     from backend.rag import (
+        EMBED_DEVICE,
+        get_embed_model,
+        get_query_model,
         ingest_document,
         retrieve,
         parse_file,
@@ -30,6 +35,9 @@ try:
     )
 except ImportError:
     from rag import (
+        EMBED_DEVICE,
+        get_embed_model,
+        get_query_model,
         ingest_document,
         retrieve,
         parse_file,
@@ -38,6 +46,16 @@ except ImportError:
         get_document_count,
     )
 
+# On CPU, load the embedding model at import time so a pre-forking server
+# (gunicorn --preload) shares its weights copy-on-write across workers.
+# CUDA/MPS can't be initialized before fork; those workers load in the startup hook below.
+if EMBED_DEVICE == "cpu":
+    get_embed_model()
+
+# Uploads are buffered in memory up to this size, then spill to a temp file
+UPLOAD_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+UPLOAD_READ_SIZE = 1 << 20
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -48,6 +66,14 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def load_models():
+    """Load GPU/MPS models in each worker after fork, before the first request."""
+    if EMBED_DEVICE != "cpu":
+        get_embed_model()
+        get_query_model()
+
+
 class RetrieveRequest(BaseModel):
     """Request model for retrieval endpoint."""
 
@@ -139,29 +165,42 @@ async def get_token(req: TokenRequest | None = Body(default=None)):
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
     """Upload a document, parse it, and ingest into FAISS index for RAG. (PDF, CSV, TXT, MD)"""
-    content = await file.read()
-    print(f"Upload request: {file.filename}, size: {len(content)} bytes")
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE) as spool:
+        while chunk := await file.read(UPLOAD_READ_SIZE):
+            spool.write(chunk)
+        print(f"Upload request: {file.filename}, size: {spool.tell()} bytes")
+        spool.seek(0)
 
-    text = parse_file(content, file.filename)
+        text = await run_in_threadpool(parse_file, spool, file.filename)
     print(f"Parsed text length: {len(text)} characters")
 
     if not text or not text.strip():
         print("ERROR: No text content extracted!")
         return {"status": "error", "message": "Could not extract text from file."}
 
-    ingest_document(text, file.filename)
+    added = await run_in_threadpool(ingest_document, text, file.filename)
 
-    indexed_docs = get_indexed_documents()
-    doc_count = get_document_count()
+    # These may take the store lock or reload the index, so keep them off the event loop
+    indexed_docs = await run_in_threadpool(get_indexed_documents)
+    doc_count = await run_in_threadpool(get_document_count)
 
     print(f"Index status: {doc_count} chunks from {indexed_docs}")
 
+    if not added:
+        return {
+            "status": "already_indexed",
+            "filename": file.filename,
+            "indexed_documents": indexed_docs,
+            "total_chunks": doc_count,
+            "message": f"{file.filename} contains no new content; it is already indexed.",
+        }
+
     return {
         "status": "ingested",
         "filename": file.filename,
         "indexed_documents": indexed_docs,
         "total_chunks": doc_count,
-        "message": f"{file.filename} has been indexed with {doc_count} chunks.",
+        "message": f"{file.filename} has been indexed with {added} new chunks ({doc_count} total).",
     }
 
 
@@ -188,7 +227,7 @@ def rag_status():
 @app.post("/retrieve")
 async def retrieve_endpoint(req: RetrieveRequest):
     """Retrieve relevant documents from FAISS index based on query."""
-    docs, sources = retrieve(req.query, req.k)
+    docs, sources = await run_in_threadpool(retrieve, req.query, req.k)
     return {"documents": docs, "metadatas": sources}
 
 
@@ -4,14 +4,22 @@ Supports PDF, CSV, TXT, MD file formats.
 Uses pypdf for PDF and pandas for CSV.
 """
 
+import hashlib
 import os
 import pickle
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from io import BytesIO
+from typing import BinaryIO
 
+import faiss
 import numpy as np
-from faiss import IndexFlatIP
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import torch
+from faiss import METRIC_INNER_PRODUCT, IndexHNSWSQ, ScalarQuantizer, index_factory
 from sentence_transformers import SentenceTransformer
 
 # Import parsers
@@ -25,26 +33,206 @@ try:
 except ImportError:
     pd = None
 
+# Cross-process lock for store writes; not available on Windows, where the backend runs as one process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 # Storage path
 RAG_DIR = Path(__file__).resolve().parent / "rag_store"
 RAG_DIR.mkdir(exist_ok=True)
 INDEX_PATH = RAG_DIR / "index.faiss"
 META_PATH = RAG_DIR / "meta.pkl"
-
-print("Loading embedding model...")
-embed_model = SentenceTransformer("BAAI/bge-small-en")
-splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-print("Embedding model loaded")
-
-
-def parse_pdf(file_content: bytes) -> str:
+CHUNKS_PATH = RAG_DIR / "chunks.bin"
+OFFSETS_PATH = RAG_DIR / "chunks_offsets.npy"
+LOCK_PATH = RAG_DIR / "store.lock"
+
+# ANN index settings: HNSW over int8 vectors for small/medium corpora, IVF-PQ once it gets large
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVFPQ_MIN_VECTORS = 100_000
+IVFPQ_NLIST = 1024
+IVFPQ_M = 16
+IVFPQ_NBITS = 8
+IVFPQ_NPROBE = 16
+IVFPQ_TRAIN_SAMPLE = 256 * IVFPQ_NLIST
+
+
+def _pick_device() -> str:
+    """Pick the fastest available torch device for the embedding model."""
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+EMBED_DEVICE = _pick_device()
+EMBED_BATCH_SIZE = 64
+
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+_CHUNK_BOUNDARY = re.compile(r"\n\n|\. |\n")
+
+
+@lru_cache(maxsize=None)
+def get_embed_model() -> SentenceTransformer:
+    """Load the embedding model once per process on first use."""
+    print(f"Loading embedding model on {EMBED_DEVICE}...")
+    model = SentenceTransformer("BAAI/bge-small-en", device=EMBED_DEVICE)
+    if EMBED_DEVICE != "cpu":
+        model.half()
+    print("Embedding model loaded")
+    return model
+
+
+@lru_cache(maxsize=None)
+def get_query_model() -> SentenceTransformer:
+    """Model for single-query encodes, kept in FP32 even when ingest runs in FP16."""
+    if EMBED_DEVICE == "cpu":
+        return get_embed_model()
+    print(f"Loading FP32 query model on {EMBED_DEVICE}...")
+    return SentenceTransformer("BAAI/bge-small-en", device=EMBED_DEVICE)
+
+
+# Encodes share one model; running them one at a time lets each use all BLAS threads
+_EMBED_LOCK = threading.Lock()
+
+
+def _embed(texts: list[str], model: SentenceTransformer) -> np.ndarray:
+    """Encode texts to normalized float32 vectors, one batch at a time under _EMBED_LOCK.
+
+    Locking per batch lets query encodes slot in between the batches of a long ingest.
+    """
+    batches = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        with _EMBED_LOCK:
+            batches.append(
+                model.encode(
+                    texts[i:i + EMBED_BATCH_SIZE],
+                    batch_size=EMBED_BATCH_SIZE,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False,
+                )
+            )
+    return np.concatenate(batches).astype(np.float32, copy=False)
+
+
+# In-memory copy of the store, reloaded only when the index file changes on disk.
+# "mapped" marks an IVF index whose lists are mmap'd read-only and must be re-read before modifying.
+_STATE = {"index": None, "meta": None, "mtime": 0, "mapped": False}
+_STATE_LOCK = threading.RLock()
+
+# Chunk count and source names for the status helpers, refreshed whenever _STATE is,
+# so polling /ragStatus costs one stat() of the index file
+_STATS = {"count": 0, "sources": set()}
+
+
+class _SemanticCache:
+    """LRU of recent queries -> retrieval results, matched by embedding similarity.
+
+    A 16-bit random-projection hash prefilters entries so the cosine check
+    only runs against candidates that share most hash bits with the query.
+    """
+
+    def __init__(self, size: int = 256, threshold: float = 0.97, bits: int = 16, min_shared_bits: int = 12):
+        self._size = size
+        self._threshold = threshold
+        self._bits = bits
+        self._max_hamming = bits - min_shared_bits
+        self._weights = (1 << np.arange(bits)).astype(np.uint16)
+        # Sized from the first inserted vector so the model isn't needed up front
+        self._planes = None
+        self._vecs = None
+        self._hashes = np.zeros(size, dtype=np.uint16)
+        self._ks = np.full(size, -1, dtype=np.int64)
+        self._texts = [None] * size
+        self._results = [None] * size
+        self._by_text = {}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by clear(); put() drops results computed against an older index
+        self.generation = 0
+
+    def get_text(self, text: str, k: int):
+        """Look up an exact (normalized) query string without embedding it."""
+        with self._lock:
+            slot = self._by_text.get((text, k))
+            if slot is None:
+                return None
+            self._lru.move_to_end(slot)
+            return self._results[slot]
+
+    def get(self, q: np.ndarray, k: int):
+        """Look up a normalized query vector; returns cached (docs, metas) or None."""
+        with self._lock:
+            if not self._lru:
+                return None
+            h = self._hash(q)
+            xor = (self._hashes ^ h).view(np.uint8)
+            hamming = np.unpackbits(xor).reshape(self._size, -1).sum(axis=1)
+            candidates = np.flatnonzero((self._ks == k) & (hamming <= self._max_hamming))
+            if candidates.size == 0:
+                return None
+            sims = self._vecs[candidates] @ q
+            best = int(np.argmax(sims))
+            if sims[best] < self._threshold:
+                return None
+            slot = int(candidates[best])
+            self._lru.move_to_end(slot)
+            return self._results[slot]
+
+    def put(self, text: str, q: np.ndarray, k: int, result, generation: int) -> None:
+        """Insert a result, evicting the least recently used entry when full."""
+        with self._lock:
+            if generation != self.generation:
+                return
+            if self._vecs is None:
+                dim = q.shape[0]
+                self._planes = np.random.default_rng(0).standard_normal((dim, self._bits)).astype(np.float32)
+                self._vecs = np.zeros((self._size, dim), dtype=np.float32)
+            h = self._hash(q)
+            if len(self._lru) < self._size:
+                slot = len(self._lru)
+            else:
+                slot, _ = self._lru.popitem(last=False)
+                self._by_text.pop((self._texts[slot], int(self._ks[slot])), None)
+            self._vecs[slot] = q
+            self._hashes[slot] = h
+            self._ks[slot] = k
+            self._texts[slot] = text
+            self._results[slot] = result
+            self._by_text[(text, k)] = slot
+            self._lru[slot] = None
+
+    def clear(self) -> None:
+        """Drop all entries, e.g. after the index changes."""
+        with self._lock:
+            self._ks.fill(-1)
+            self._texts = [None] * self._size
+            self._results = [None] * self._size
+            self._by_text.clear()
+            self._lru.clear()
+            self.generation += 1
+
+    def _hash(self, q: np.ndarray) -> np.uint16:
+        return np.uint16((q @ self._planes > 0) @ self._weights)
+
+
+_QUERY_CACHE = _SemanticCache()
+
+
+def parse_pdf(file: BinaryIO) -> str:
     """Extract text from PDF using pypdf."""
     if PdfReader is None:
         raise ImportError("pypdf is required. Install: pip install pypdf")
 
     try:
-        reader = PdfReader(BytesIO(file_content))
+        reader = PdfReader(file)
         text_parts = []
         for i, page in enumerate(reader.pages):
             text = page.extract_text()
@@ -61,156 +249,499 @@ def parse_pdf(file_content: bytes) -> str:
         return ""
 
 
-def parse_csv(file_content: bytes) -> str:
+def parse_csv(file: BinaryIO) -> str:
     """Extract text from CSV using pandas."""
     if pd is None:
         raise ImportError("pandas is required. Install: pip install pandas")
 
     try:
-        df = pd.read_csv(BytesIO(file_content))
-        text_parts = []
-        for idx, row in df.iterrows():
-            row_text = " | ".join([f"{col}: {val}" for col, val in row.items() if pd.notna(val)])
-            if row_text:
-                text_parts.append(row_text)
+        df = pd.read_csv(file)
+        # Build "col: val | col: val" rows one column at a time, skipping NaN cells
+        row_text = pd.Series("", index=df.index, dtype=object)
+        for col in df.columns:
+            present = df[col].notna()
+            prefix = row_text[present]
+            prefix = prefix.where(prefix == "", prefix + " | ")
+            row_text[present] = prefix + f"{col}: " + df.loc[present, col].astype(str)
+        text_parts = row_text[row_text != ""].tolist()
         result = "\n\n".join(text_parts)
         print(f"CSV parsed successfully: {len(result)} characters, {len(text_parts)} rows")
         return result
     except Exception as e:
         print(f"CSV parsing error: {e}")
-        return file_content.decode("utf-8", errors="ignore")
+        file.seek(0)
+        return file.read().decode("utf-8", errors="ignore")
 
 
-def parse_file(file_content: bytes, filename: str) -> str:
-    """Parse file content based on file extension."""
+def parse_file(file: BinaryIO, filename: str) -> str:
+    """Parse a binary file-like object based on file extension."""
     ext = filename.lower().split(".")[-1] if "." in filename else ""
 
     print(f"Parsing file: {filename} (extension: {ext})")
 
     if ext == "pdf":
-        return parse_pdf(file_content)
+        return parse_pdf(file)
     elif ext == "csv":
-        return parse_csv(file_content)
+        return parse_csv(file)
     else:
         # txt, md, or any text file
-        return file_content.decode("utf-8", errors="ignore")
+        return file.read().decode("utf-8", errors="ignore")
+
+
+class _ChunkStore:
+    """Append-only UTF-8 chunk file with an (offset, length) table, read via mmap.
+
+    Only the chunks actually returned by a search are decoded, so lookups do not
+    pay for the rest of the corpus.
+    """
+
+    def __init__(self, data_path: Path, offsets_path: Path):
+        self._data_path = data_path
+        self._offsets_path = offsets_path
+        if offsets_path.exists():
+            self._offsets = np.load(offsets_path)
+        else:
+            self._offsets = np.zeros((0, 2), dtype=np.int64)
+        self._data = None
+
+    @classmethod
+    def create(cls, data_path: Path, offsets_path: Path) -> "_ChunkStore":
+        """Start an empty store, discarding any chunk files left on disk."""
+        data_path.unlink(missing_ok=True)
+        offsets_path.unlink(missing_ok=True)
+        return cls(data_path, offsets_path)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> str:
+        offset, length = self._offsets[i]
+        if self._data is None:
+            self._data = np.memmap(self._data_path, dtype=np.uint8, mode="r")
+        return self._data[offset:offset + length].tobytes().decode("utf-8")
+
+    def truncate(self, n: int) -> None:
+        """Forget rows past n. The next extend() persists the shorter table."""
+        self._offsets = self._offsets[:n]
+
+    def extend(self, chunks: list[str]) -> None:
+        """Append chunks to the data file and persist the offset table."""
+        encoded = [c.encode("utf-8") for c in chunks]
+        lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+        start = self._data_path.stat().st_size if self._data_path.exists() else 0
+        offsets = start + np.cumsum(lengths) - lengths
+
+        with open(self._data_path, "ab") as f:
+            f.write(b"".join(encoded))
+        self._offsets = np.concatenate([self._offsets, np.column_stack([offsets, lengths])])
+        _atomic_write(self._offsets_path, lambda f: np.save(f, self._offsets))
+        self._data = None
 
 
 def _load_store():
-    """Load FAISS index and metadata from disk."""
-    if not INDEX_PATH.exists():
-        return None, {"documents": [], "metadatas": []}
+    """Return the cached FAISS index and metadata, loading from disk if stale."""
+    with _STATE_LOCK:
+        if not INDEX_PATH.exists():
+            meta = _empty_meta([])
+            _update_stats(meta)
+            return None, meta
+
+        mtime = INDEX_PATH.stat().st_mtime_ns
+        if _STATE["index"] is None or mtime != _STATE["mtime"]:
+            index = _faiss_read(INDEX_PATH)
+            meta = _read_meta()
+            if _is_legacy_meta(meta):
+                with _store_write_lock():
+                    # Another worker may have migrated while we waited for the lock
+                    meta = _read_meta()
+                    if _is_legacy_meta(meta):
+                        meta = _migrate_meta(meta)
+            documents = _ChunkStore(CHUNKS_PATH, OFFSETS_PATH)
+            # A write interrupted after the chunk files but before the index leaves extra
+            # rows past index.ntotal; ignore them (in memory only, a writer may be mid-ingest)
+            if len(documents) > index.ntotal or len(meta["source_ids"]) > index.ntotal:
+                documents.truncate(index.ntotal)
+                meta["source_ids"] = meta["source_ids"][:index.ntotal]
+                meta.pop("hashes", None)
+            meta["documents"] = documents
+            if "hashes" not in meta:
+                meta["hashes"] = {_chunk_hash(documents[i]) for i in range(len(documents))}
+
+            _STATE["index"] = index
+            _STATE["meta"] = meta
+            _STATE["mtime"] = mtime
+            _STATE["mapped"] = _has_mapped_lists(index)
+            _update_stats(meta)
+            _QUERY_CACHE.clear()
+
+        return _STATE["index"], _STATE["meta"]
+
+
+def _read_meta() -> dict:
+    """Load meta.pkl, or empty metadata if it doesn't exist yet."""
+    if not META_PATH.exists():
+        return {"sources": [], "source_ids": np.zeros(0, dtype=np.int32)}
+    with open(META_PATH, "rb") as f:
+        return pickle.load(f)
+
+
+def _is_legacy_meta(meta: dict) -> bool:
+    """True for meta.pkl written before chunk text and sources moved out of it."""
+    return isinstance(meta.get("documents"), list) or "metadatas" in meta
+
+
+def _migrate_meta(meta: dict) -> dict:
+    """Convert legacy metadata in place and persist it. Caller must hold _store_write_lock()."""
+    if isinstance(meta.get("documents"), list):
+        # Chunk text moves out of meta.pkl into the chunk files
+        documents = _ChunkStore.create(CHUNKS_PATH, OFFSETS_PATH)
+        documents.extend(meta.pop("documents"))
+    if "metadatas" in meta:
+        # Per-chunk {"source": ...} dicts become a source table plus chunk ids
+        meta["sources"] = []
+        source_ids = [
+            _source_id(meta, m.get("source", "unknown") if isinstance(m, dict) else "unknown")
+            for m in meta.pop("metadatas")
+        ]
+        meta["source_ids"] = np.array(source_ids, dtype=np.int32)
+    _write_meta(meta)
+    return meta
+
+
+def _update_stats(meta: dict) -> None:
+    """Refresh _STATS from store metadata."""
+    _STATS["count"] = len(meta["documents"])
+    _STATS["sources"] = set(meta["sources"])
+
+
+def _stats() -> dict:
+    """Return _STATS, reloading the store first if another process changed it."""
+    _load_store()
+    return _STATS
+
+
+def _empty_meta(documents) -> dict:
+    """Metadata for a store with no chunks.
+
+    Each chunk's source is stored as an int32 id into the "sources" list rather
+    than as a per-chunk dict.
+    """
+    return {"documents": documents, "sources": [], "source_ids": np.zeros(0, dtype=np.int32), "hashes": set()}
+
+
+def _source_id(meta: dict, source: str) -> int:
+    """Return the id of source in meta["sources"], adding it if new."""
+    sources = meta["sources"]
+    try:
+        return sources.index(source)
+    except ValueError:
+        sources.append(source)
+        return len(sources) - 1
+
 
-    index = _faiss_read(INDEX_PATH)
-    meta = {"documents": [], "metadatas": []}
+def _save_store(index, meta):
+    """Persist FAISS index and metadata. Chunk text is persisted by _ChunkStore.extend.
 
-    if META_PATH.exists():
-        with open(META_PATH, "rb") as f:
-            meta = pickle.load(f)
+    The index is written last: its mtime is what tells other processes to reload.
+    """
+    _write_meta(meta)
+    _faiss_write(index, INDEX_PATH)
 
-    return index, meta
 
+def _write_meta(meta: dict) -> None:
+    """Pickle everything but the chunk text to META_PATH."""
+    data = {key: value for key, value in meta.items() if key != "documents"}
+    _atomic_write(META_PATH, lambda f: pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL))
 
-def _save_store(index, documents, metadatas):
-    """Persist FAISS index and metadata."""
-    _faiss_write(index, INDEX_PATH)
-    with open(META_PATH, "wb") as f:
-        pickle.dump({"documents": documents, "metadatas": metadatas}, f)
+
+def _atomic_write(path: Path, write) -> None:
+    """Write a file via a temp file and rename, so readers never see a partial file."""
+    tmp_path = Path(str(path) + ".tmp")
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def _store_write_lock():
+    """Hold an exclusive lock on the store across processes (e.g. gunicorn workers)."""
+    if fcntl is None:
+        yield
+        return
+    with open(LOCK_PATH, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def split_text(text: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """Split text into chunks of at most chunk_size chars, ending at paragraph/sentence/line breaks.
+
+    Boundaries are found in a single regex pass; chunks are then cut greedily with a
+    two-pointer walk, each overlapping the previous one by up to chunk_overlap chars.
+    """
+    n = len(text)
+    boundaries = [m.end() for m in _CHUNK_BOUNDARY.finditer(text)]
+    chunks = []
+    start = 0
+    prev_end = 0
+    while start < n:
+        # Cut points must lie past the previous chunk's end so every chunk adds new text
+        lo = max(start, prev_end)
+        limit = start + chunk_size
+        if limit >= n:
+            end = n
+        else:
+            i = bisect_right(boundaries, limit) - 1
+            if i >= 0 and boundaries[i] > lo:
+                end = boundaries[i]
+            else:
+                # No separator in the window: fall back to the last space, then a hard cut
+                space = text.rfind(" ", lo, limit)
+                end = space + 1 if space > lo else limit
+
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= n:
+            break
+
+        # Overlap by up to chunk_overlap chars, starting at a boundary (or a space) in that window
+        next_start = end - chunk_overlap
+        if next_start <= start:
+            next_start = end
+        else:
+            j = bisect_left(boundaries, next_start)
+            if j < len(boundaries) and boundaries[j] < end:
+                next_start = boundaries[j]
+            else:
+                space = text.find(" ", next_start, end)
+                if space != -1:
+                    next_start = space + 1
+        prev_end = end
+        start = next_start
+    return chunks
+
+
+def _chunk_hash(chunk: str) -> bytes:
+    """Fingerprint a chunk for de-duplication."""
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
 
 
 def _faiss_write(index, path):
-    """Write FAISS index to file."""
-    import faiss
-    faiss.write_index(index, str(path))
+    """Write FAISS index to file.
+
+    Writes to a temp file and renames it into place so a previously mmap'd index
+    keeps reading its old pages instead of a file being truncated underneath it.
+    """
+    tmp_path = Path(str(path) + ".tmp")
+    faiss.write_index(index, str(tmp_path))
+    os.replace(tmp_path, path)
 
 
 def _faiss_read(path):
-    """Read FAISS index from file."""
-    import faiss
-    return faiss.read_index(str(path))
+    """Read FAISS index from file, memory-mapped so pages are loaded on demand."""
+    try:
+        return faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        return faiss.read_index(str(path))
+
+
+def _has_mapped_lists(index) -> bool:
+    """True if the index is IVF with inverted lists mmap'd by IO_FLAG_MMAP.
+
+    The flag only affects IVF lists; other index types are read fully into memory.
+    """
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return False
+    return isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
 
 
-def _l2_normalize(x: np.ndarray) -> np.ndarray:
-    """L2 normalize for cosine similarity via inner product."""
-    norms = np.linalg.norm(x, axis=1, keepdims=True)
-    return np.divide(x, norms, where=norms > 0)
+def _new_index(dim: int):
+    """Create an empty HNSW inner-product index over int8 scalar-quantized vectors."""
+    index = IndexHNSWSQ(dim, ScalarQuantizer.QT_8bit, HNSW_M, METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
 
 
-def ingest_document(text: str, source: str) -> None:
-    """Chunk text, embed, and add to vector store."""
+def _train_index(index, embeddings: np.ndarray) -> None:
+    """Train the scalar quantizer on the full [-1, 1] range of normalized components.
+
+    Adding -1/+1 rows fixes every dimension's range up front, so vectors from later
+    documents are not clipped to whatever range the first (possibly tiny) upload had.
+    """
+    dim = embeddings.shape[1]
+    bounds = np.vstack([np.full((1, dim), -1.0), np.full((1, dim), 1.0)]).astype(np.float32)
+    index.train(np.vstack([embeddings, bounds]))
+
+
+def _needs_ivfpq(index, n_new: int) -> bool:
+    """True if adding n_new vectors takes a non-IVF index past the IVF-PQ threshold."""
+    return index is not None and not hasattr(index, "nprobe") and index.ntotal + n_new >= IVFPQ_MIN_VECTORS
+
+
+def _build_ivfpq(vectors: np.ndarray, embeddings: np.ndarray):
+    """Train an IVF-PQ index on existing vectors plus new embeddings, and add the existing vectors."""
+    train_vectors = np.vstack([vectors, embeddings])
+    dim = train_vectors.shape[1]
+    print(f"Rebuilding index as IVF-PQ over {len(train_vectors)} vectors...")
+
+    ivf = index_factory(dim, f"IVF{IVFPQ_NLIST},PQ{IVFPQ_M}x{IVFPQ_NBITS}", METRIC_INNER_PRODUCT)
+    rng = np.random.default_rng(0)
+    sample = train_vectors[rng.choice(len(train_vectors), min(len(train_vectors), IVFPQ_TRAIN_SAMPLE), replace=False)]
+    ivf.train(sample)
+    ivf.add(vectors)
+    return ivf
+
+
+def _set_search_params(index) -> None:
+    """Apply query-time accuracy/speed knobs for the index type."""
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = IVFPQ_NPROBE
+
+
+def ingest_document(text: str, source: str) -> int:
+    """Chunk text, embed, and add to vector store. Returns the number of new chunks indexed."""
     print(f"Ingesting document: {source}, text length: {len(text)}")
 
     if not text or not text.strip():
         print(f"Warning: No text content to ingest from {source}")
-        return
+        return 0
 
-    chunks = splitter.split_text(text)
+    chunks = split_text(text)
     print(f"Split into {len(chunks)} chunks")
 
     if not chunks:
         print(f"Warning: No chunks created from {source}")
-        return
+        return 0
+
+    # Skip chunks already in the index or repeated within this document
+    _, meta = _load_store()
+    seen = meta.get("hashes", set())
+    unique = {}
+    for chunk in chunks:
+        key = _chunk_hash(chunk)
+        if key not in seen and key not in unique:
+            unique[key] = chunk
+    if len(unique) < len(chunks):
+        print(f"Skipping {len(chunks) - len(unique)} duplicate chunks")
+    if not unique:
+        print(f"Warning: All chunks from {source} are already indexed")
+        return 0
+    chunks = list(unique.values())
 
     print("Generating embeddings...")
-    embeddings = embed_model.encode(chunks, convert_to_numpy=True)
-    embeddings = _l2_normalize(embeddings.astype(np.float32))
+    embeddings = _embed(chunks, get_embed_model())
     print(f"Embeddings shape: {embeddings.shape}")
 
-    metadatas = [{"source": source}] * len(chunks)
-
-    index, meta = _load_store()
-    if index is None:
-        dim = embeddings.shape[1]
-        index = IndexFlatIP(dim)
-        meta = {"documents": [], "metadatas": []}
-
-    index.add(embeddings)
-    meta["documents"].extend(chunks)
-    meta["metadatas"].extend(metadatas)
-
-    _save_store(index, meta["documents"], meta["metadatas"])
+    # Training IVF-PQ takes tens of seconds; do it from a snapshot outside the locks so
+    # retrievals keep being served, then only add the rows that arrived meanwhile
+    ivf, base = None, 0
+    index, _ = _load_store()
+    if _needs_ivfpq(index, len(embeddings)):
+        with _STATE_LOCK:
+            base = index.ntotal
+            snapshot = index.reconstruct_n(0, base)
+        ivf = _build_ivfpq(snapshot, embeddings)
+        del snapshot
+
+    with _STATE_LOCK, _store_write_lock():
+        # Reload under the lock so writes by other processes are picked up first
+        index, meta = _load_store()
+        if index is None:
+            dim = embeddings.shape[1]
+            index = _new_index(dim)
+            _train_index(index, embeddings)
+            meta = _empty_meta(_ChunkStore.create(CHUNKS_PATH, OFFSETS_PATH))
+        elif _STATE["mapped"]:
+            # On-disk lists can't be cloned or appended to; load a writable copy instead
+            index = faiss.read_index(str(INDEX_PATH))
+
+        try:
+            if ivf is not None and not hasattr(index, "nprobe") and index.ntotal >= base:
+                if index.ntotal > base:
+                    ivf.add(index.reconstruct_n(base, index.ntotal - base))
+                ivf.add(embeddings)
+                index = ivf
+            elif _needs_ivfpq(index, len(embeddings)):
+                # Crossed the threshold via a concurrent ingest; rare enough to build in place
+                built = _build_ivfpq(index.reconstruct_n(0, index.ntotal), embeddings)
+                built.add(embeddings)
+                index = built
+            else:
+                index.add(embeddings)
+            meta["documents"].extend(chunks)
+            sid = _source_id(meta, source)
+            meta["source_ids"] = np.concatenate([meta["source_ids"], np.full(len(chunks), sid, dtype=np.int32)])
+            meta["hashes"].update(unique)
+
+            _save_store(index, meta)
+        except Exception:
+            # The cached index/meta may be half-updated; force the next call to reload from disk
+            _STATE["index"] = None
+            raise
+        _STATE["index"] = index
+        _STATE["meta"] = meta
+        _STATE["mtime"] = INDEX_PATH.stat().st_mtime_ns
+        _STATE["mapped"] = False
+        _update_stats(meta)
+        _QUERY_CACHE.clear()
     print(f"Document {source} indexed successfully. Total chunks: {len(meta['documents'])}")
+    return len(chunks)
 
 
 def retrieve(query: str, k: int = 4):
     """Retrieve top-k similar chunks."""
+    # Taken before the store is read, so results from an index replaced mid-call are never cached
+    generation = _QUERY_CACHE.generation
     index, meta = _load_store()
     if index is None or not meta.get("documents"):
         return [], []
 
-    q = embed_model.encode([query], convert_to_numpy=True)
-    q = _l2_normalize(q.astype(np.float32))
-    scores, indices = index.search(q, min(k, index.ntotal))
-
-    docs = meta["documents"]
-    metas = meta["metadatas"]
-    out_docs = [docs[i] for i in indices[0] if 0 <= i < len(docs)]
-    out_metas = [metas[i] if i < len(metas) else {"source": "unknown"} for i in indices[0] if 0 <= i < len(docs)]
-
+    text_key = " ".join(query.lower().split())
+    cached = _QUERY_CACHE.get_text(text_key, k)
+    if cached is not None:
+        print(f"Retrieved {len(cached[0])} documents (cached) for query: {query[:50]}...")
+        return cached
+
+    q = _embed([query], get_query_model())
+    cached = _QUERY_CACHE.get(q[0], k)
+    if cached is not None:
+        print(f"Retrieved {len(cached[0])} documents (cached) for query: {query[:50]}...")
+        return cached
+
+    with _STATE_LOCK:
+        _set_search_params(index)
+        scores, indices = index.search(q, min(k, index.ntotal))
+
+        docs = meta["documents"]
+        sources = meta["sources"]
+        source_ids = meta["source_ids"]
+        hits = [i for i in indices[0] if 0 <= i < len(docs)]
+        out_docs = [docs[i] for i in hits]
+        out_metas = [{"source": sources[source_ids[i]] if i < len(source_ids) else "unknown"} for i in hits]
+
+    _QUERY_CACHE.put(text_key, q[0], k, (out_docs, out_metas), generation)
     print(f"Retrieved {len(out_docs)} documents for query: {query[:50]}...")
     return out_docs, out_metas
 
 
 def get_indexed_documents():
     """Get list of indexed document sources."""
-    _, meta = _load_store()
-    if not meta.get("documents"):
-        return []
-
-    sources = set()
-    for m in meta.get("metadatas", []):
-        if isinstance(m, dict) and m.get("source"):
-            sources.add(m["source"])
-    return list(sources)
+    return list(_stats()["sources"])
 
 
 def get_document_count():
     """Get total number of indexed documents/chunks."""
-    _, meta = _load_store()
-    return len(meta.get("documents", []))
+    return _stats()["count"]
 
 
 def is_index_ready():
     """Check if the index has any documents."""
-    _, meta = _load_store()
-    return len(meta.get("documents", [])) > 0
+    return _stats()["count"] > 0
@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.rag import split_text
+
+
+def _assert_well_formed(text, chunks, chunk_size=500, chunk_overlap=50):
+    assert all(0 < len(c) <= chunk_size for c in chunks)
+    # Each chunk must advance by close to a full window, not creep forward char by char
+    assert len(chunks) <= len(text) // (chunk_size - 2 * chunk_overlap) + 2
+
+
+def test_long_separator_free_rows():
+    row = " | ".join(f"col{i}: value{i:03d}" for i in range(50))
+    text = "\n\n".join([row] * 5)
+
+    chunks = split_text(text)
+
+    _assert_well_formed(text, chunks)
+
+
+def test_short_sentence_before_long_run():
+    text = "Hi. " + "word " * 200
+    chunks = split_text(text)
+
+    _assert_well_formed(text, chunks)
+    assert chunks[0] == "Hi."
+    assert all(c.startswith("word") for c in chunks[1:])
+
+
+def test_no_whitespace_hard_cut():
+    text = "x" * 1300
+    chunks = split_text(text)
+
+    _assert_well_formed(text, chunks)
+    assert len(chunks) == 3